@@ -1,57 +1,282 @@
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, CallbackQueryHandler, filters
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta
+from functools import lru_cache
+from operator import itemgetter
+import asyncio
 import json
+import logging
+import math
+import orjson
 import os
 
 from dotenv import load_dotenv
 import os
 
+logger = logging.getLogger(__name__)
+
 load_dotenv()  # loads .env file automatically
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 
 if not TOKEN:
     raise ValueError("❌ Telegram bot token not found. Check your .env file.")
 
-# -------------------- Data storage --------------------
-DATA_FILE = "expenses.json"
-
-# Structure: {user_id: {date_str: [(name, amount, category), ...]}}
-expenses = {}
+# Off by default: updates queued while the bot was down are usually expenses we still want to record
+DROP_PENDING_UPDATES = os.getenv("DROP_PENDING_UPDATES") == "1"
 
-# Load expenses from file if exists
-if os.path.exists(DATA_FILE):
-    with open(DATA_FILE, "r") as f:
-        expenses = json.load(f)
-        # JSON stores numbers as float but keys are strings, we may need conversion later
+# -------------------- Data storage --------------------
+# Append-only log, one JSON record per line:
+#   {"op": "snapshot", "expenses": {...}}  full state, written by compact()
+#   {"op": "add", "uid": ..., "date": ..., "entry": [name, cents, category]}
+#   {"op": "del", "uid": ..., "date": ...}  removes the last entry of that day
+DATA_FILE = "expenses.jsonl"
+LEGACY_DATA_FILE = "expenses.json"  # full-dict dump used by older versions
+COMPACT_MAX_LINES = 1000
+# Records are buffered in memory and written out at most this often (seconds)
+BATCH_FLUSH_INTERVAL = float(os.getenv("BATCH_FLUSH_INTERVAL", "3"))
+
+# Largest amount accepted for one expense, in cents ($1,000,000,000)
+MAX_AMOUNT_CENTS = 100_000_000_000
+
+# Structure: {user_id: {date_str: [(name, amount, category), ...]}}, amounts in integer cents
+expenses = defaultdict(lambda: defaultdict(list))
+amount_of = itemgetter(1)  # (name, amount, category) -> amount
+
+# Same day lists grouped by month: {user_id: {"YYYY-MM": {date_str: [...]}}}
+month_index = defaultdict(lambda: defaultdict(dict))
+
+# Running totals: {user_id: {date_str: amount}} and {user_id: {date_str: {category: amount}}}
+day_totals = defaultdict(lambda: defaultdict(int))
+day_cat_totals = defaultdict(lambda: defaultdict(lambda: defaultdict(int)))
+
+log_file = None
+log_lines = 0
+last_compact = None
+pending_records = []
+dirty = asyncio.Event()
+flush_lock = asyncio.Lock()
+flusher_task = None
+
+# Serialises each user's add/undo and the reply that follows, so their summaries stay in order
+# while different users' updates still run concurrently
+user_locks = defaultdict(asyncio.Lock)
+
+def to_cents(dollars):
+    """Convert a dollar amount to int cents, or None if it is not finite or exceeds MAX_AMOUNT_CENTS."""
+    # Check the magnitude before multiplying: a huge finite value like 1e307 overflows to inf
+    if not math.isfinite(dollars) or abs(dollars) > MAX_AMOUNT_CENTS / 100:
+        return None
+    return round(dollars * 100)
+
+def load_entry(entry):
+    name, amount, category = entry
+    if isinstance(amount, float):
+        # Older data stored dollars as floats, and accepted nan/inf. Keep unusable amounts
+        # as zero rather than dropping the entry, so later "del" records still line up.
+        amount = to_cents(amount) or 0
+    return (name, amount, category)
+
+def parse_json(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # Older versions wrote with the stdlib json, which emits NaN/Infinity that orjson rejects
+        return json.loads(data)
+
+def apply_record(rec):
+    op = rec["op"]
+    if op == "snapshot":
+        expenses.clear()
+        for uid, days in rec["expenses"].items():
+            expenses[uid] = defaultdict(list, {day: [load_entry(e) for e in entries] for day, entries in days.items()})
+    elif op == "add":
+        expenses[rec["uid"]][rec["date"]].append(load_entry(rec["entry"]))
+    elif op == "del":
+        day_expenses = expenses.get(rec["uid"], {}).get(rec["date"])
+        if day_expenses:
+            day_expenses.pop()
+
+def index_day(user_id, day_str, day_expenses):
+    month_index[user_id][day_str[:7]][day_str] = day_expenses
+
+def total_day(user_id, day_str, day_expenses):
+    category_totals = defaultdict(int)
+    for entry in day_expenses:
+        category_totals[entry[2]] += entry[1]
+    day_cat_totals[user_id][day_str] = category_totals
+    day_totals[user_id][day_str] = sum(map(amount_of, day_expenses))
+
+def add_to_totals(user_id, day_str, amount, category):
+    day_totals[user_id][day_str] += amount
+    day_cat_totals[user_id][day_str][category] += amount
+
+def build_indexes():
+    month_index.clear()
+    day_totals.clear()
+    day_cat_totals.clear()
+    for user_id, user_data in expenses.items():
+        for day_str, day_expenses in user_data.items():
+            index_day(user_id, day_str, day_expenses)
+            total_day(user_id, day_str, day_expenses)
+
+def load_expenses():
+    """Rebuild expenses by replaying the log line by line. Returns True if it needs compacting."""
+    global log_lines
+    needs_compact = False
+    if os.path.exists(DATA_FILE):
+        line = b"\n"
+        with open(DATA_FILE, "rb") as f:
+            for line in f:
+                try:
+                    apply_record(parse_json(line))
+                except ValueError:
+                    # Partial line from a crash mid-append (bad JSON, or cut inside a UTF-8 character);
+                    # rewrite the log so new records start clean
+                    needs_compact = True
+                    continue
+                log_lines += 1
+        # A complete record missing its newline would have the next append glued onto it
+        if not line.endswith(b"\n"):
+            needs_compact = True
+        needs_compact = needs_compact or log_lines > COMPACT_MAX_LINES
+    elif os.path.exists(LEGACY_DATA_FILE):
+        with open(LEGACY_DATA_FILE, "rb") as f:
+            apply_record({"op": "snapshot", "expenses": parse_json(f.read())})
+        needs_compact = True
+    build_indexes()
+    return needs_compact
+
+def write_snapshot(line):
+    global log_file
+    # Write to a temp file and swap it in, so a crash leaves either the old log or the new one
+    tmp = DATA_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+    if log_file:
+        log_file.close()
+    os.replace(tmp, DATA_FILE)
+    log_file = open(DATA_FILE, "ab")
+
+def write_record(lines):
+    # Called once per flush interval, so the fsync is shared by the whole batch
+    log_file.write(lines)
+    log_file.flush()
+    os.fsync(log_file.fileno())
+
+# All file access runs on one worker thread so writes hit the disk in the order they were queued
+io_executor = ThreadPoolExecutor(max_workers=1)
+
+async def run_io(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, func, *args)
+
+async def compact():
+    """Replace the log with a single snapshot of the current state."""
+    global log_lines, last_compact
+    # Serialise on the event loop so the snapshot matches exactly the records queued before it
+    line = orjson.dumps({"op": "snapshot", "expenses": expenses}, option=orjson.OPT_APPEND_NEWLINE)
+    await run_io(write_snapshot, line)
+    log_lines = 1
+    last_compact = date.today()
+
+async def flush():
+    """Write out buffered records, or a fresh snapshot when the log is due for compaction."""
+    global log_lines, last_compact
+    async with flush_lock:
+        count = len(pending_records)
+        if not count:
+            return
+        try:
+            if log_lines + count > COMPACT_MAX_LINES or last_compact != date.today():
+                await compact()  # the snapshot already contains the buffered records
+            else:
+                await run_io(write_record, b"".join(pending_records[:count]))
+                log_lines += count
+        except Exception:
+            # A failed append may have left a partial line, so rewrite the whole log next time
+            last_compact = None
+            raise
+        # Records buffered while the write was in progress stay for the next flush
+        del pending_records[:count]
+
+def encode_record(rec):
+    return orjson.dumps(rec, option=orjson.OPT_APPEND_NEWLINE)
+
+def append_record(line):
+    pending_records.append(line)
+    dirty.set()
+
+async def flusher():
+    while True:
+        await dirty.wait()
+        await asyncio.sleep(BATCH_FLUSH_INTERVAL)
+        dirty.clear()
+        try:
+            # Shielded so cancelling at shutdown cannot abandon a write half-way through
+            await asyncio.shield(flush())
+        except Exception:
+            logger.exception("Failed to write expenses log, retrying in %s seconds", BATCH_FLUSH_INTERVAL)
+            dirty.set()
+
+async def post_init(app):
+    global log_file, last_compact, flusher_task
+    if await run_io(load_expenses):
+        await compact()
+    else:
+        log_file = await run_io(open, DATA_FILE, "ab")
+        last_compact = date.today()
+    flusher_task = asyncio.create_task(flusher())
+
+async def post_shutdown(app):
+    # PTB runs this even when post_init failed, so don't assume the log or the flusher exist
+    if flusher_task:
+        flusher_task.cancel()
+    if log_file is None:
+        return
+    try:
+        await flush()
+    finally:
+        await run_io(log_file.close)
 
 # Categories
 CATEGORIES = ["Food", "Drinks", "Entertainment", "Misc.", "Transport", "Travel", "Housing"]
+CATEGORY_SET = frozenset(CATEGORIES)
+CATEGORY_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton(cat, callback_data=cat)] for cat in CATEGORIES])
 
 # -------------------- Helper functions --------------------
-def save_expenses():
-    with open(DATA_FILE, "w") as f:
-        json.dump(expenses, f)
+def format_amount(cents):
+    if cents < 0:
+        return "$-%d.%02d" % divmod(-cents, 100)
+    return "$%d.%02d" % divmod(cents, 100)
 
-def get_user_data(user_id):
-    today_str = str(date.today())
+def get_user_data(user_id, today_str):
     user_data = expenses.get(str(user_id), {})
     return user_data.get(today_str, [])
 
 def format_summary(expense_list):
-    total = sum(amount for _, amount, _ in expense_list)
-    lines = [f"{name}: ${amount:.2f} ({category})" for name, amount, category in expense_list]
-    return "\n".join(lines) + f"\n\n💰 Total: ${total:.2f}"
+    # Entries are tuples, so an identical day (repeated /summary) hits the cache
+    return format_summary_cached(tuple(expense_list))
 
-def add_expense_to_data(user_id, name, amount, category):
+@lru_cache(maxsize=1024)
+def format_summary_cached(expense_list):
+    total = sum(map(amount_of, expense_list))
+    lines = ["%s: %s (%s)" % (name, format_amount(amount), category) for name, amount, category in expense_list]
+    lines.append(f"\n💰 Total: {format_amount(total)}")
+    return "\n".join(lines)
+
+def add_expense_to_data(user_id, name, amount, category, today_str):
     user_id = str(user_id)
-    today_str = str(date.today())
-    if user_id not in expenses:
-        expenses[user_id] = {}
-    if today_str not in expenses[user_id]:
-        expenses[user_id][today_str] = []
-    expenses[user_id][today_str].append((name, amount, category))
-    save_expenses()
+    # Encode first: if the record cannot be serialised, memory must not get ahead of the log
+    line = encode_record({"op": "add", "uid": user_id, "date": today_str, "entry": [name, amount, category]})
+    today_expenses = expenses[user_id][today_str]
+    today_expenses.append((name, amount, category))
+    index_day(user_id, today_str, today_expenses)
+    add_to_totals(user_id, today_str, amount, category)
+    append_record(line)
+    return today_expenses
 
 # -------------------- Command Handlers --------------------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -79,53 +304,61 @@ async def add_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     except ValueError:
         await update.message.reply_text("⚠️ Amount must be a number.")
         return
+    amount = to_cents(amount)
+    if amount is None:
+        await update.message.reply_text(f"⚠️ Amount must be a number no larger than {format_amount(MAX_AMOUNT_CENTS)}.")
+        return
 
     # Save temporarily in context
     context.user_data['pending_expense'] = (name, amount)
 
     # Show category buttons
-    keyboard = [[InlineKeyboardButton(cat, callback_data=cat)] for cat in CATEGORIES]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(f"Select a category for \"{name} - ${amount:.2f}\":", reply_markup=reply_markup)
+    await update.message.reply_text(f"Select a category for \"{name} - {format_amount(amount)}\":", reply_markup=CATEGORY_MARKUP)
 
 async def category_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     category = query.data
+    if category not in CATEGORY_SET:
+        return  # not one of our buttons; leave any pending expense as it is
 
     if 'pending_expense' not in context.user_data:
         await query.edit_message_text("⚠️ No pending expense found.")
         return
 
     name, amount = context.user_data.pop('pending_expense')
-    user_id = query.from_user.id
-    add_expense_to_data(user_id, name, amount, category)
-
-    today_expenses = get_user_data(user_id)
-    summary_text = format_summary(today_expenses)
-    await query.edit_message_text(
-        f"✅ Recorded: {name} - ${amount:.2f} ({category})\n\n🧾 Today's summary:\n{summary_text}"
-    )
+    user_id = str(query.from_user.id)
+    today_str = date.today().isoformat()
+    async with user_locks[user_id]:
+        today_expenses = add_expense_to_data(user_id, name, amount, category, today_str)
+        summary_text = format_summary(today_expenses)
+        await query.edit_message_text(
+            f"✅ Recorded: {name} - {format_amount(amount)} ({category})\n\n🧾 Today's summary:\n{summary_text}"
+        )
 
 # -------------------- Undo --------------------
 async def undo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    today_str = str(date.today())
-    today_expenses = expenses.get(user_id, {}).get(today_str, [])
-    if not today_expenses:
-        await update.message.reply_text("⚠️ No expenses to undo today.")
-        return
-    removed = today_expenses.pop()
-    save_expenses()
-    summary_text = format_summary(today_expenses) if today_expenses else "No expenses today."
-    await update.message.reply_text(
-        f"✅ Removed last entry: {removed[0]} - ${removed[1]:.2f} ({removed[2]})\n\n🧾 Updated summary:\n{summary_text}"
-    )
+    today_str = date.today().isoformat()
+    async with user_locks[user_id]:
+        today_expenses = expenses.get(user_id, {}).get(today_str, [])
+        if not today_expenses:
+            await update.message.reply_text("⚠️ No expenses to undo today.")
+            return
+        line = encode_record({"op": "del", "uid": user_id, "date": today_str})
+        removed = today_expenses.pop()
+        # Recount the day rather than subtracting, so emptied categories drop out cleanly
+        total_day(user_id, today_str, today_expenses)
+        append_record(line)
+        summary_text = format_summary(today_expenses) if today_expenses else "No expenses today."
+        await update.message.reply_text(
+            f"✅ Removed last entry: {removed[0]} - {format_amount(removed[1])} ({removed[2]})\n\n🧾 Updated summary:\n{summary_text}"
+        )
 
 # -------------------- Summaries --------------------
 async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    today_expenses = get_user_data(user_id)
+    today_expenses = get_user_data(user_id, date.today().isoformat())
     if not today_expenses:
         await update.message.reply_text("No expenses today.")
         return
@@ -134,73 +367,71 @@ async def summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def week_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    user_data = expenses.get(user_id, {})
-    lines = []
+    totals = day_totals.get(user_id, {})
+    today = date.today()
+    lines = ["🧾 Weekly summary:"]
     total_week = 0
     for i in range(7):
-        day = date.today() - timedelta(days=i)
-        day_str = str(day)
-        day_expenses = user_data.get(day_str, [])
-        day_total = sum(amount for _, amount, _ in day_expenses)
+        day_str = (today - timedelta(days=i)).isoformat()
+        day_total = totals.get(day_str, 0)
         total_week += day_total
-        lines.append(f"{day}: ${day_total:.2f}")
-    summary_text = "\n".join(lines) + f"\n\n💰 Total week: ${total_week:.2f}"
-    await update.message.reply_text(f"🧾 Weekly summary:\n{summary_text}")
+        lines.append("%s: %s" % (day_str, format_amount(day_total)))
+    lines.append(f"\n💰 Total week: {format_amount(total_week)}")
+    await update.message.reply_text("\n".join(lines))
 
 # -------------------- Monthly daily totals --------------------
 async def month_daily_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    user_data = expenses.get(user_id, {})
-    today = date.today()
-    
-    daily_totals = []
-    total_month = 0
-    for day_str, day_expenses in sorted(user_data.items()):
-        day_date = date.fromisoformat(day_str)
-        if day_date.month == today.month and day_date.year == today.year:
-            day_total = sum(amount for _, amount, _ in day_expenses)
-            daily_totals.append(f"{day_str}: ${day_total:.2f}")
-            total_month += day_total
-
-    if not daily_totals:
+    month_data = month_index.get(user_id, {}).get(date.today().strftime("%Y-%m"), {})
+    if not month_data:
         await update.message.reply_text("No expenses recorded this month.")
         return
 
-    summary_text = "\n".join(daily_totals)
-    summary_text += f"\n\n💰 Total month: ${total_month:.2f}"
-    await update.message.reply_text(f"🧾 Monthly daily summary:\n{summary_text}")
+    # Only this month's days (at most 31) are sorted; totals are accumulated while formatting
+    totals = day_totals[user_id]
+    lines = ["🧾 Monthly daily summary:"]
+    total_month = 0
+    for day_str in sorted(month_data):
+        day_total = totals[day_str]
+        lines.append("%s: %s" % (day_str, format_amount(day_total)))
+        total_month += day_total
+    lines.append(f"\n💰 Total month: {format_amount(total_month)}")
+    await update.message.reply_text("\n".join(lines))
 
 # -------------------- Monthly category summary --------------------
 async def month_category_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.message.from_user.id)
-    user_data = expenses.get(user_id, {})
-    today = date.today()
+    month_data = month_index.get(user_id, {}).get(date.today().strftime("%Y-%m"), {})
+    cat_totals = day_cat_totals.get(user_id, {})
 
-    category_totals = {}
+    category_totals = defaultdict(int)
     total_month = 0
-    for day_str, day_expenses in user_data.items():
-        day_date = date.fromisoformat(day_str)
-        if day_date.month == today.month and day_date.year == today.year:
-            for _, amount, category in day_expenses:
-                category_totals[category] = category_totals.get(category, 0) + amount
-                total_month += amount
+    for day_str in month_data:
+        for category, amount in cat_totals[day_str].items():
+            category_totals[category] += amount
+            total_month += amount
 
     if total_month == 0:
         await update.message.reply_text("No expenses recorded this month.")
-        returnpy
+        return
 
-    lines = []
+    lines = ["🧾 Monthly category summary:"]
     for cat, amt in category_totals.items():
         percent = (amt / total_month) * 100
-        lines.append(f"{cat}: ${amt:.2f} ({percent:.1f}%)")
-
-    summary_text = "\n".join(lines)
-    summary_text += f"\n\n💰 Total month: ${total_month:.2f}"
-    await update.message.reply_text(f"🧾 Monthly category summary:\n{summary_text}")
+        lines.append("%s: %s (%.1f%%)" % (cat, format_amount(amt), percent))
+    lines.append(f"\n💰 Total month: {format_amount(total_month)}")
+    await update.message.reply_text("\n".join(lines))
 
 # -------------------- Main --------------------
 def main():
-    app = ApplicationBuilder().token(TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     app.add_handler(CommandHandler("start", start))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, add_expense))
     app.add_handler(CallbackQueryHandler(category_selected))
@@ -211,7 +442,7 @@ def main():
     app.add_handler(CommandHandler("month_category", month_category_summary))
 
     print("✅ MoneyTracker Bot is running...")
-    app.run_polling()
+    app.run_polling(drop_pending_updates=DROP_PENDING_UPDATES)
 
 if __name__ == "__main__":
     main()